@@ -0,0 +1,264 @@
+import json
+import os
+from datetime import datetime
+from typing import Any, Optional
+
+import redis.asyncio as redis
+
+
+_REDIS: redis.Redis | None = None
+
+
+def get_redis() -> Optional[redis.Redis]:
+    """
+    Create (or return) a pooled async Redis client.
+
+    Optional:
+      - REDIS_URL: e.g. redis://host:6379/0. When unset, caching is disabled
+        and every helper below behaves like a cache miss.
+    """
+    global _REDIS
+    if _REDIS is None:
+        url = os.getenv("REDIS_URL")
+        if not url:
+            return None
+        _REDIS = redis.Redis.from_url(url)
+    return _REDIS
+
+
+async def close_redis() -> None:
+    global _REDIS
+    if _REDIS is not None:
+        await _REDIS.aclose()
+        _REDIS = None
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+async def get_json(key: str) -> Optional[dict]:
+    r = get_redis()
+    if r is None:
+        return None
+    try:
+        raw = await r.get(key)
+    except redis.RedisError:
+        # The cache is best-effort; fall back to the source of truth.
+        return None
+    if raw is None:
+        return None
+    return json.loads(raw)
+
+
+# After a write, readers may not fill the entry for this long. It covers a
+# reader that fetched the old row before the write committed (DB statements
+# are capped at 60s) and would otherwise cache it after the writer's delete.
+_WRITE_GUARD_SECONDS = 60
+
+# SETEX KEYS[1] unless the write guard KEYS[2] exists, atomically.
+_SETEX_UNLESS_GUARDED = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+redis.call('SETEX', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+
+def _guard_key(key: str) -> str:
+    return f"{key}:write-guard"
+
+
+async def set_json(key: str, value: dict, ttl_seconds: int) -> None:
+    """
+    Fill a read-through entry, unless invalidate_json() ran for it recently.
+    """
+    r = get_redis()
+    if r is None:
+        return
+    try:
+        await r.eval(
+            _SETEX_UNLESS_GUARDED,
+            2,
+            key,
+            _guard_key(key),
+            ttl_seconds,
+            json.dumps(value, default=_json_default),
+        )
+    except redis.RedisError:
+        pass
+
+
+async def invalidate_json(key: str) -> None:
+    """
+    Drop an entry after its source changed and keep stale readers from
+    re-filling it for _WRITE_GUARD_SECONDS.
+    """
+    r = get_redis()
+    if r is None:
+        return
+    try:
+        await r.set(_guard_key(key), 1, ex=_WRITE_GUARD_SECONDS)
+    except redis.RedisError:
+        pass
+    try:
+        await r.delete(key)
+    except redis.RedisError:
+        pass
+
+
+# Every indexed set also holds this member once it has been fully populated.
+# Real members must therefore be non-empty strings.
+_READY_MEMBER = ""
+
+
+async def set_add(key: str, *members: str) -> bool:
+    r = get_redis()
+    if r is None:
+        return False
+    if not members:
+        return True
+    try:
+        await r.sadd(key, *members)
+    except redis.RedisError:
+        return False
+    return True
+
+
+async def set_remove(key: str, member: str) -> None:
+    r = get_redis()
+    if r is None:
+        return
+    try:
+        await r.srem(key, member)
+    except redis.RedisError:
+        pass
+
+
+def _epoch_key(key: str) -> str:
+    return f"{key}:epoch"
+
+
+# DEL the set KEYS[1] and bump its epoch KEYS[2], atomically.
+_INVALIDATE_SET = """
+redis.call('DEL', KEYS[1])
+redis.call('INCR', KEYS[2])
+return 1
+"""
+
+# SADD the ready marker ARGV[2] to KEYS[1] only if its epoch KEYS[2] still
+# equals ARGV[1], atomically.
+_MARK_READY_UNLESS_INVALIDATED = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('SADD', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+async def set_invalidate(key: str) -> bool:
+    """
+    Drop the whole set, including its ready marker, so lookups fall back to
+    the source of truth until it is repopulated. Also keeps a population
+    that started earlier from marking the set ready.
+
+    Returns False only if Redis is enabled and the delete failed.
+    """
+    r = get_redis()
+    if r is None:
+        return True
+    try:
+        await r.eval(_INVALIDATE_SET, 2, key, _epoch_key(key))
+    except redis.RedisError:
+        return False
+    return True
+
+
+async def set_epoch(key: str) -> Optional[str]:
+    """
+    Return the set's current epoch, to be passed to set_mark_ready() once it
+    has been populated. None if Redis is disabled or failed.
+    """
+    r = get_redis()
+    if r is None:
+        return None
+    try:
+        raw = await r.get(_epoch_key(key))
+    except redis.RedisError:
+        return None
+    return "" if raw is None else raw.decode()
+
+
+async def set_mark_ready(key: str, epoch: str) -> bool:
+    """
+    Mark the set fully populated, unless set_invalidate() ran since epoch
+    was read.
+    """
+    r = get_redis()
+    if r is None:
+        return False
+    try:
+        return bool(
+            await r.eval(_MARK_READY_UNLESS_INVALIDATED, 2, key, _epoch_key(key), epoch, _READY_MEMBER)
+        )
+    except redis.RedisError:
+        return False
+
+
+async def set_is_ready(key: str) -> bool:
+    r = get_redis()
+    if r is None:
+        return False
+    try:
+        return bool(await r.sismember(key, _READY_MEMBER))
+    except redis.RedisError:
+        return False
+
+
+async def set_contains(key: str, member: str) -> Optional[bool]:
+    """
+    Check set membership in one round-trip.
+
+    Returns None when the answer is unknown: caching is disabled, Redis
+    failed, or the set was never marked ready (e.g. Redis was flushed), so
+    callers must fall back to the source of truth.
+    """
+    r = get_redis()
+    if r is None:
+        return None
+    try:
+        ready, present = await r.smismember(key, [_READY_MEMBER, member])
+    except redis.RedisError:
+        return None
+    if not ready:
+        return None
+    return bool(present)
+
+
+async def acquire_lock(key: str, ttl_seconds: int) -> bool:
+    """
+    Take a best-effort lock that expires after ttl_seconds.
+
+    Returns False if Redis is disabled, failed, or another holder has it.
+    """
+    r = get_redis()
+    if r is None:
+        return False
+    try:
+        return bool(await r.set(key, 1, nx=True, ex=ttl_seconds))
+    except redis.RedisError:
+        return False
+
+
+async def release_lock(key: str) -> None:
+    r = get_redis()
+    if r is None:
+        return
+    try:
+        await r.delete(key)
+    except redis.RedisError:
+        pass
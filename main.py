@@ -1,18 +1,31 @@
+import os
 from contextlib import asynccontextmanager
 
 from ec2_metadata import ec2_metadata
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 
-from db import get_engine, init_db
-from routers.images import router as images_router
+import cache
+import s3_client
+from db import get_engine, init_db, warm_up
+from routers.images import prime_name_index, router as images_router
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: create tables if needed (single-table demo setup).
-    init_db(get_engine())
-    yield
-    # Shutdown: nothing to clean up explicitly.
+    # Startup: create tables only when asked to (e.g. a one-shot init job);
+    # otherwise just open the first DB connection so requests don't pay for it.
+    if os.getenv("RUN_DB_INIT") == "1":
+        await init_db(get_engine())
+    else:
+        await warm_up(get_engine())
+    # Let unknown image names be rejected from Redis without a DB query.
+    await prime_name_index()
+    async with s3_client.s3_client_lifespan():
+        yield
+    # Shutdown: S3 client is closed above; release pooled DB/Redis connections.
+    await get_engine().dispose()
+    await cache.close_redis()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -21,9 +34,22 @@ app = FastAPI(lifespan=lifespan)
 app.include_router(images_router, prefix="/images", tags=["images"])
 
 
+# Placement never changes for a running instance, so IMDS is queried once.
+_PLACEMENT: tuple[str, str] | None = None
+
+
+def _fetch_placement() -> tuple[str, str]:
+    return ec2_metadata.availability_zone, ec2_metadata.region
+
+
 @app.get("/")
 async def get_root():
+    global _PLACEMENT
+    if _PLACEMENT is None:
+        # Only the first call pays for the blocking IMDS requests, off the event loop.
+        _PLACEMENT = await run_in_threadpool(_fetch_placement)
+    az, region = _PLACEMENT
     return {
-        'az': ec2_metadata.availability_zone,
-        'region': ec2_metadata.region,
+        'az': az,
+        'region': region,
     }
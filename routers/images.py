@@ -1,29 +1,52 @@
-import io
+import asyncio
+import functools
+import logging
 import mimetypes
+import os
 import random
+import re
+import uuid
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
-
-from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
+from typing import NamedTuple, Optional
+
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Depends,
+    File,
+    Form,
+    Header,
+    HTTPException,
+    Query,
+    Response,
+    UploadFile,
+)
 from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from sqlalchemy import func, select
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
-
-from db import Image, get_db
+from pydantic import BaseModel, ConfigDict
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import Image, get_db, get_session_factory
+import cache
 import s3_client
 
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 
 class ImageMetadata(BaseModel):
+    # Built straight from DB rows / cached records via model_validate.
+    model_config = ConfigDict(frozen=True, from_attributes=True)
+
     last_updated_at: datetime
     name: str
     size_bytes: int
     extension: str
+    uploaded: bool
 
 
 class DeleteResult(BaseModel):
@@ -31,80 +54,362 @@ class DeleteResult(BaseModel):
     deleted: bool
 
 
-def _guess_content_type(name: str, extension: str) -> str:
-    content_type, _ = mimetypes.guess_type(f"{name}.{extension}")
+@functools.lru_cache(maxsize=128)
+def _guess_content_type(extension: str) -> str:
+    # Only the extension affects the guess, and the set of extensions is small.
+    content_type, _ = mimetypes.guess_type(f"file.{extension}")
     return content_type or "application/octet-stream"
 
 
-def _get_by_name(db: Session, name: str) -> Image:
-    image = db.execute(select(Image).where(Image.name == name)).scalar_one_or_none()
-    if not image:
+_IMAGE_CACHE_TTL_SECONDS = 300
+
+_DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Dialect-specific INSERT constructs that support ON CONFLICT DO UPDATE.
+_DIALECT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+# Columns needed to build ImageMetadata; selecting them directly skips ORM hydration.
+_METADATA_COLUMNS = (
+    Image.last_updated_at,
+    Image.name,
+    Image.size_bytes,
+    Image.extension,
+    Image.uploaded,
+)
+
+
+class _ImageRecord(NamedTuple):
+    last_updated_at: datetime
+    name: str
+    size_bytes: int
+    extension: str
+    uploaded: bool
+    s3_key: str
+
+
+# Redis set of every stored image name, used to reject unknown names cheaply.
+_NAMES_KEY = "images:names"
+_NAME_INDEX_BATCH_SIZE = 1000
+# Held while one worker rebuilds the name set, so the others don't all rescan.
+_NAME_INDEX_LOCK_KEY = "images:names:prime-lock"
+_NAME_INDEX_LOCK_SECONDS = 300
+_NAME_INDEX_PRIME_TASK: Optional[asyncio.Task] = None
+
+
+_BYTE_RANGE_RE = re.compile(r"bytes=(\d+-\d*|-\d+)")
+
+
+class InvalidRangeError(ValueError):
+    pass
+
+
+def normalize_byte_range(value: str) -> str:
+    """
+    Validate a single-range HTTP Range header value, e.g. "bytes=0-1023".
+
+    S3 GetObject only honours one range per request.
+    """
+    value = value.strip().replace(" ", "")
+    match = _BYTE_RANGE_RE.fullmatch(value)
+    if not match:
+        raise InvalidRangeError("Malformed or unsupported Range header")
+    first, _, last = match.group(1).partition("-")
+    if first and last and int(last) < int(first):
+        raise InvalidRangeError("Malformed or unsupported Range header")
+    return value
+
+
+def _image_cache_key(name: str) -> str:
+    return f"img:{name}"
+
+
+async def prime_name_index() -> None:
+    """
+    Load all image names into the Redis name set and mark it ready.
+
+    No-op when Redis is disabled, the set is already populated, or another
+    worker is populating it.
+    """
+    if cache.get_redis() is None or await cache.set_is_ready(_NAMES_KEY):
+        return
+    if not await cache.acquire_lock(_NAME_INDEX_LOCK_KEY, _NAME_INDEX_LOCK_SECONDS):
+        return
+    try:
+        # If the set is invalidated while we scan, names added before that
+        # are gone, so the set must not be marked ready by this pass.
+        epoch = await cache.set_epoch(_NAMES_KEY)
+        if epoch is None:
+            return
+        async with get_session_factory()() as db:
+            result = await db.stream_scalars(select(Image.name))
+            async for names in result.partitions(_NAME_INDEX_BATCH_SIZE):
+                if not await cache.set_add(_NAMES_KEY, *names):
+                    # An incomplete set must never be marked ready.
+                    return
+        await cache.set_mark_ready(_NAMES_KEY, epoch)
+    finally:
+        await cache.release_lock(_NAME_INDEX_LOCK_KEY)
+
+
+async def _prime_name_index_in_background() -> None:
+    try:
+        await prime_name_index()
+    except Exception:
+        logger.exception("Rebuilding the image name index failed")
+
+
+def _schedule_name_index_prime() -> None:
+    """
+    Rebuild the name set in the background, e.g. after it was invalidated
+    or Redis was flushed. At most one rebuild runs per worker.
+    """
+    global _NAME_INDEX_PRIME_TASK
+    if _NAME_INDEX_PRIME_TASK is None or _NAME_INDEX_PRIME_TASK.done():
+        _NAME_INDEX_PRIME_TASK = asyncio.create_task(_prime_name_index_in_background())
+
+
+async def _index_name(name: str) -> bool:
+    """
+    Add name to the name set.
+
+    If that fails the set would be incomplete, so it is invalidated instead.
+    Returns False only if neither worked.
+    """
+    if cache.get_redis() is None or await cache.set_add(_NAMES_KEY, name):
+        return True
+    return await cache.set_invalidate(_NAMES_KEY)
+
+
+async def _unindex_name(db: AsyncSession, name: str) -> None:
+    """
+    Remove name from the name set after its row was deleted.
+
+    An upload of the same name may have committed, and run its SADD, before
+    our SREM; re-check the database so its name is not lost from the set.
+    """
+    await cache.set_remove(_NAMES_KEY, name)
+    if (await db.execute(select(Image.id).where(Image.name == name))).first() is not None:
+        await _index_name(name)
+
+
+async def _get_by_name(db: AsyncSession, name: str) -> _ImageRecord:
+    """
+    Look up an image by name, serving hot names from the Redis cache.
+    """
+    cached = await cache.get_json(_image_cache_key(name))
+    if cached is not None:
+        cached["last_updated_at"] = datetime.fromisoformat(cached["last_updated_at"])
+        return _ImageRecord(**cached)
+
+    indexed = await cache.set_contains(_NAMES_KEY, name)
+    if indexed is False:
+        raise HTTPException(status_code=404, detail="Image not found")
+    if indexed is None and cache.get_redis() is not None:
+        _schedule_name_index_prime()
+
+    row = (
+        await db.execute(select(*_METADATA_COLUMNS, Image.s3_key).where(Image.name == name))
+    ).one_or_none()
+    if row is None:
         raise HTTPException(status_code=404, detail="Image not found")
+
+    image = _ImageRecord(*row)
+    await cache.set_json(
+        _image_cache_key(name), image._asdict(), ttl_seconds=_IMAGE_CACHE_TTL_SECONDS
+    )
     return image
 
 
 @router.get("/random/metadata", response_model=ImageMetadata)
-def get_random_metadata(db: Session = Depends(get_db)):
-    total = db.execute(select(func.count(Image.id))).scalar_one()
-    if total == 0:
+async def get_random_metadata(db: AsyncSession = Depends(get_db)):
+    # Both the bounds and the pick are primary-key index seeks; no COUNT(*) or OFFSET scan.
+    # Ids left by deleted rows make the pick slightly uneven, which is fine for a random sample.
+    min_id, max_id = (await db.execute(select(func.min(Image.id), func.max(Image.id)))).one()
+    if min_id is None:
         raise HTTPException(status_code=404, detail="No images available")
 
-    offset = random.randrange(total)
-    image = (
-        db.execute(select(Image).order_by(Image.id).offset(offset).limit(1))
-        .scalar_one()
-    )
+    pivot = random.randint(min_id, max_id)
+    row = (
+        await db.execute(
+            select(*_METADATA_COLUMNS).where(Image.id >= pivot).order_by(Image.id).limit(1)
+        )
+    ).one_or_none()
+    if row is None:
+        # Rows above the pivot were deleted between the two queries.
+        raise HTTPException(status_code=404, detail="No images available")
 
-    return ImageMetadata(
-        last_updated_at=image.last_updated_at,
-        name=image.name,
-        size_bytes=image.size_bytes,
-        extension=image.extension,
-    )
+    return ImageMetadata.model_validate(row)
 
 
 @router.get("/{name}/metadata", response_model=ImageMetadata)
-def get_metadata(name: str, db: Session = Depends(get_db)):
-    image = _get_by_name(db, name)
-    return ImageMetadata(
-        last_updated_at=image.last_updated_at,
-        name=image.name,
-        size_bytes=image.size_bytes,
-        extension=image.extension,
-    )
+async def get_metadata(name: str, db: AsyncSession = Depends(get_db)):
+    image = await _get_by_name(db, name)
+    return ImageMetadata.model_validate(image)
 
 
 @router.get("/{name}")
-def download_by_name(name: str, db: Session = Depends(get_db)):
-    image = _get_by_name(db, name)
+async def download_by_name(
+    name: str,
+    db: AsyncSession = Depends(get_db),
+    range_header: Optional[str] = Header(default=None, alias="range"),
+):
+    image = await _get_by_name(db, name)
+    if not image.uploaded:
+        raise HTTPException(status_code=409, detail="Image upload is still in progress")
+
+    byte_range = None
+    if range_header is not None:
+        try:
+            byte_range = normalize_byte_range(range_header)
+        except InvalidRangeError as e:
+            raise HTTPException(status_code=416, detail=str(e)) from e
 
     try:
-        obj = s3_client.download_image(key=image.s3_key)
+        obj = await s3_client.download_image(key=image.s3_key, byte_range=byte_range)
+    except s3_client.RangeNotSatisfiableError as e:
+        headers = None
+        if e.object_size is not None:
+            # RFC 9110 15.5.17: tell the client the current length.
+            headers = {"Content-Range": f"bytes */{e.object_size}"}
+        raise HTTPException(status_code=416, detail=str(e), headers=headers) from e
     except Exception as e:  # boto3 raises various exception types
         raise HTTPException(status_code=502, detail="Failed to download from S3") from e
 
     body = obj["Body"]
-    content_type = obj.get("ContentType") or _guess_content_type(image.name, image.extension)
-
-    def iter_chunks():
-        while True:
-            chunk = body.read(1024 * 1024)
-            if not chunk:
-                break
-            yield chunk
+    content_type = obj.get("ContentType") or _guess_content_type(image.extension)
 
     headers = {
-        "Content-Disposition": f'attachment; filename="{image.name}.{image.extension}"'
+        "Content-Disposition": f'attachment; filename="{image.name}.{image.extension}"',
+        "Accept-Ranges": "bytes",
     }
-    return StreamingResponse(iter_chunks(), media_type=content_type, headers=headers)
+    if obj.get("ContentLength") is not None:
+        headers["Content-Length"] = str(obj["ContentLength"])
+
+    status_code = 200
+    if byte_range is not None and obj.get("ContentRange"):
+        status_code = 206
+        headers["Content-Range"] = obj["ContentRange"]
+
+    return StreamingResponse(
+        body.iter_chunks(chunk_size=_DOWNLOAD_CHUNK_SIZE),
+        status_code=status_code,
+        media_type=content_type,
+        headers=headers,
+    )
+
+
+# A background upload retries recording its result, so a transient DB error
+# does not leave its row pending forever.
+_FINISH_UPLOAD_DB_ATTEMPTS = 3
+_FINISH_UPLOAD_DB_RETRY_SECONDS = 1.0
+
+
+async def _delete_orphaned_object(db: AsyncSession, name: str, key: str) -> None:
+    """
+    Delete an object whose upload lost its claim on the row, unless a row
+    still references the key or a newer upload of the name is pending.
+    """
+    in_use = (Image.s3_key == key) | ((Image.name == name) & Image.upload_token.is_not(None))
+    if (await db.execute(select(Image.id).where(in_use).limit(1))).first() is not None:
+        return
+    try:
+        await s3_client.delete_image(key=key)
+    except Exception:
+        logger.exception("Deleting orphaned S3 object %r failed", key)
+
+
+async def _finish_upload(
+    *,
+    fileobj,
+    name: str,
+    size_bytes: int,
+    extension: str,
+    key: str,
+    content_type: Optional[str],
+    token: str,
+) -> None:
+    """
+    Background half of an asynchronous upload: push the object to S3, then
+    apply the new values to the row it claimed.
+
+    Nothing happens to the row if a later upload has claimed it or it was
+    deleted since; the pushed object is deleted unless still in use. If S3
+    fails, a row this upload created is dropped and a previously stored image
+    is left exactly as it was.
+    """
+    owned = (Image.name == name) & (Image.upload_token == token)
+    try:
+        await s3_client.upload_image(fileobj=fileobj, key=key, content_type=content_type)
+    except Exception:
+        logger.exception("Background upload of image %r to S3 failed", name)
+        statements = [
+            delete(Image).where(owned, Image.uploaded.is_(False)),
+            # Release the claim without bumping the stored image's timestamp.
+            update(Image)
+            .where(owned)
+            .values(upload_token=None, last_updated_at=Image.last_updated_at),
+        ]
+        uploaded = False
+    else:
+        statements = [
+            update(Image)
+            .where(owned)
+            .values(
+                size_bytes=size_bytes,
+                extension=extension,
+                s3_key=key,
+                uploaded=True,
+                upload_token=None,
+            ),
+        ]
+        uploaded = True
+
+    # The statements only touch a row this upload still owns, so re-running
+    # them after an ambiguous commit failure is harmless.
+    for attempt in range(1, _FINISH_UPLOAD_DB_ATTEMPTS + 1):
+        try:
+            async with get_session_factory()() as db:
+                results = [await db.execute(stmt) for stmt in statements]
+                await db.commit()
+            break
+        except SQLAlchemyError:
+            if attempt == _FINISH_UPLOAD_DB_ATTEMPTS:
+                logger.exception(
+                    "Recording background upload of image %r failed; it stays pending until re-uploaded",
+                    name,
+                )
+                return
+            await asyncio.sleep(_FINISH_UPLOAD_DB_RETRY_SECONDS * attempt)
+
+    await cache.invalidate_json(_image_cache_key(name))
+    async with get_session_factory()() as db:
+        if uploaded and not results[0].rowcount:
+            await _delete_orphaned_object(db, name, key)
+        elif not uploaded and results[0].rowcount:
+            await _unindex_name(db, name)
 
 
 @router.post("", response_model=ImageMetadata)
-def upload(
-    db: Session = Depends(get_db),
+async def upload(
+    response: Response,
+    background: BackgroundTasks,
+    db: AsyncSession = Depends(get_db),
     file: UploadFile = File(...),
     name: Optional[str] = Form(default=None),
+    sync: bool = Query(default=False),
 ):
+    """
+    Store an image and its metadata.
+
+    By default the S3 upload runs after the response (202): a new name gets a
+    pending row, while an existing image keeps serving its current version
+    until the replacement is in S3. Pass sync=true to wait for S3 before
+    responding (200).
+    """
     filename = file.filename or ""
     path = Path(filename)
 
@@ -122,65 +427,111 @@ def upload(
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e)) from e
 
+    # The upload is already spooled by Starlette, which also tracks its size while
+    # parsing; only fall back to measuring the spooled file when that is missing.
+    size_bytes = file.size
     try:
-        data = file.file.read()
+        if size_bytes is None:
+            file.file.seek(0, os.SEEK_END)
+            size_bytes = file.file.tell()
+        file.file.seek(0)
     except Exception as e:
         raise HTTPException(status_code=400, detail="Failed to read upload") from e
 
-    size_bytes = len(data)
     if size_bytes == 0:
         raise HTTPException(status_code=400, detail="Uploaded file is empty")
 
-    content_type = file.content_type or _guess_content_type(final_name, extension)
+    content_type = file.content_type or _guess_content_type(extension)
 
-    try:
-        s3_client.upload_image(fileobj=io.BytesIO(data), key=key, content_type=content_type)
-    except Exception as e:
-        raise HTTPException(status_code=502, detail="Failed to upload to S3") from e
-
-    # Upsert-like behavior: overwrite existing record if present.
-    existing = db.execute(select(Image).where(Image.name == final_name)).scalar_one_or_none()
-    if existing:
-        existing.size_bytes = size_bytes
-        existing.extension = extension
-        existing.s3_key = key
-        db.add(existing)
-        db.commit()
-        db.refresh(existing)
-        image = existing
-    else:
-        image = Image(
-            name=final_name,
-            size_bytes=size_bytes,
-            extension=extension,
-            s3_key=key,
-        )
-        db.add(image)
+    # The UploadFile itself is handed to S3: its read() runs in the threadpool
+    # once the spool is on disk, keeping blocking reads off the event loop.
+    if sync:
         try:
-            db.commit()
-        except IntegrityError as e:
-            db.rollback()
-            raise HTTPException(status_code=409, detail="Image name already exists") from e
-        db.refresh(image)
-
+            await s3_client.upload_image(fileobj=file, key=key, content_type=content_type)
+        except Exception as e:
+            raise HTTPException(status_code=502, detail="Failed to upload to S3") from e
+
+    # Index the name before committing so the name set never misses a stored image.
+    # If that fails the set is dropped, and lookups use the database until it
+    # is rebuilt in the background. If even the drop fails, Redis still holds
+    # a ready set without this name, which would 404 it once Redis recovers;
+    # so while the name index is enabled, uploads need Redis to be reachable.
+    if not await _index_name(final_name):
+        raise HTTPException(status_code=503, detail="Image name index unavailable")
+
+    token = None if sync else uuid.uuid4().hex
+
+    # Single atomic upsert keyed on the name.
+    insert = _DIALECT_INSERTS[db.get_bind().dialect.name]
+    stmt = insert(Image).values(
+        name=final_name,
+        size_bytes=size_bytes,
+        extension=extension,
+        s3_key=key,
+        uploaded=sync,
+        upload_token=token,
+    )
+    if sync:
+        # Overwrite the existing record; this also supersedes any pending async upload.
+        set_ = {
+            "size_bytes": stmt.excluded.size_bytes,
+            "extension": stmt.excluded.extension,
+            "s3_key": stmt.excluded.s3_key,
+            "uploaded": stmt.excluded.uploaded,
+            "upload_token": None,
+            # ON CONFLICT bypasses the column's onupdate, so bump it explicitly.
+            "last_updated_at": func.now(),
+        }
+    else:
+        # Only claim the existing record; its values change once S3 has the new object.
+        set_ = {"upload_token": stmt.excluded.upload_token}
+    stmt = stmt.on_conflict_do_update(index_elements=[Image.name], set_=set_).returning(
+        *_METADATA_COLUMNS
+    )
+    row = (await db.execute(stmt)).one()
+    await db.commit()
+
+    # Index again: a concurrent delete of this name may have run its SREM
+    # between our first SADD and the commit.
+    await _index_name(final_name)
+    await cache.invalidate_json(_image_cache_key(final_name))
+
+    if sync:
+        return ImageMetadata.model_validate(row)
+
+    # The spooled upload stays open until the background task has run.
+    background.add_task(
+        _finish_upload,
+        fileobj=file,
+        name=final_name,
+        size_bytes=size_bytes,
+        extension=extension,
+        key=key,
+        content_type=content_type,
+        token=token,
+    )
+    response.status_code = 202
     return ImageMetadata(
-        last_updated_at=image.last_updated_at,
-        name=image.name,
-        size_bytes=image.size_bytes,
-        extension=image.extension,
+        last_updated_at=row.last_updated_at,
+        name=final_name,
+        size_bytes=size_bytes,
+        extension=extension,
+        uploaded=False,
     )
 
 
 @router.delete("/{name}", response_model=DeleteResult)
-def delete_by_name(name: str, db: Session = Depends(get_db)):
-    image = _get_by_name(db, name)
+async def delete_by_name(name: str, db: AsyncSession = Depends(get_db)):
+    image = await _get_by_name(db, name)
 
     try:
-        s3_client.delete_image(key=image.s3_key)
+        await s3_client.delete_image(key=image.s3_key)
     except Exception as e:
         raise HTTPException(status_code=502, detail="Failed to delete from S3") from e
 
-    db.delete(image)
-    db.commit()
+    await db.execute(delete(Image).where(Image.name == name))
+    await db.commit()
+    await cache.invalidate_json(_image_cache_key(name))
+    await _unindex_name(db, name)
     return DeleteResult(name=name, deleted=True)
 
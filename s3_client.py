@@ -1,8 +1,13 @@
+import functools
 import os
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from typing import IO, Optional
+from typing import IO, AsyncIterator, Awaitable, Optional, Protocol, Union
 
-import boto3
+import aioboto3
+from aiobotocore.config import AioConfig
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 
 
 def _require_env(name: str) -> str:
@@ -12,6 +17,11 @@ def _require_env(name: str) -> str:
     return value
 
 
+# Allow only a conservative set of characters
+_ALLOWED_NAME_CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_"
+_DISALLOWED_NAME_BYTES = bytes(b for b in range(256) if chr(b) not in _ALLOWED_NAME_CHARS)
+
+
 def sanitize_image_name(name: str) -> str:
     """
     Keep it S3-key-safe and predictable.
@@ -20,9 +30,9 @@ def sanitize_image_name(name: str) -> str:
     if not name:
         raise ValueError("Image name must not be empty")
 
-    # Allow only a conservative set of characters
-    allowed = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_"
-    cleaned = "".join(ch for ch in name if ch in allowed)
+    # Non-ASCII characters are never allowed, so drop them while encoding and
+    # strip the rest in a single C-level bytes.translate pass.
+    cleaned = name.encode("ascii", "ignore").translate(None, _DISALLOWED_NAME_BYTES).decode("ascii")
     if not cleaned:
         raise ValueError("Image name contains no allowed characters")
     return cleaned
@@ -47,6 +57,7 @@ class S3Config:
     region: Optional[str]
 
 
+@functools.lru_cache(maxsize=1)
 def get_s3_config() -> S3Config:
     return S3Config(
         bucket=_require_env("AWS_S3_BUCKET"),
@@ -54,36 +65,108 @@ def get_s3_config() -> S3Config:
     )
 
 
-def get_s3_client():
+_session = aioboto3.Session()
+# Bodies above 8 MiB go through a multipart upload with up to 4 parts in
+# flight. The read-ahead queue is bounded too, so one upload buffers at most
+# ~9 parts (4 in flight + 4 queued + 1 being read, ~72 MiB) whatever its size.
+_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+    max_io_queue=4,
+)
+# One client-wide HTTP connection pool sized for concurrent requests; idle
+# HTTP keep-alive connections are held long enough to be reused between
+# bursts. (aiobotocore ignores botocore's tcp_keepalive socket option, so
+# connector_args is the only knob here.)
+_CLIENT_CONFIG = AioConfig(
+    max_pool_connections=50,
+    retries={"mode": "adaptive", "max_attempts": 5},
+    s3={"addressing_style": "virtual"},
+    connector_args={"keepalive_timeout": 60},
+)
+_CLIENT = None
+_BUCKET: str | None = None
+
+
+@asynccontextmanager
+async def s3_client_lifespan() -> AsyncIterator[None]:
+    """
+    Open the process-wide S3 client for the lifetime of the app.
+
+    Creating a client loads botocore service models and opens a fresh HTTP
+    connection pool, so it is done once and reused by every request.
+    """
+    global _CLIENT, _BUCKET
     cfg = get_s3_config()
-    if cfg.region:
-        return boto3.client("s3", region_name=cfg.region)
-    return boto3.client("s3")
+    async with _session.client("s3", region_name=cfg.region, config=_CLIENT_CONFIG) as client:
+        _CLIENT = client
+        _BUCKET = cfg.bucket
+        try:
+            yield
+        finally:
+            _CLIENT = None
+            _BUCKET = None
 
 
-def upload_image(*, fileobj: IO[bytes], key: str, content_type: Optional[str]) -> None:
-    cfg = get_s3_config()
+def get_s3_client():
+    if _CLIENT is None:
+        raise RuntimeError("S3 client is not initialized")
+    return _CLIENT
+
+
+class AsyncReadable(Protocol):
+    def read(self, size: int = -1) -> Awaitable[bytes]: ...
+
+
+async def upload_image(
+    *, fileobj: Union[IO[bytes], AsyncReadable], key: str, content_type: Optional[str]
+) -> None:
+    """
+    Upload fileobj to S3. Prefer an object with an awaitable read() (e.g.
+    fastapi's UploadFile): aioboto3 calls read() on the event loop, so a plain
+    file would block it on disk I/O.
+    """
     client = get_s3_client()
     extra_args = {}
     if content_type:
         extra_args["ContentType"] = content_type
     if extra_args:
-        client.upload_fileobj(fileobj, cfg.bucket, key, ExtraArgs=extra_args)
+        await client.upload_fileobj(
+            fileobj, _BUCKET, key, ExtraArgs=extra_args, Config=_TRANSFER_CONFIG
+        )
     else:
-        client.upload_fileobj(fileobj, cfg.bucket, key)
+        await client.upload_fileobj(fileobj, _BUCKET, key, Config=_TRANSFER_CONFIG)
+
+
+class RangeNotSatisfiableError(Exception):
+    def __init__(self, object_size: Optional[int]):
+        super().__init__("Requested range not satisfiable")
+        self.object_size = object_size
 
 
-def download_image(*, key: str):
+async def download_image(*, key: str, byte_range: Optional[str] = None):
     """
     Returns the raw S3 get_object response (includes streaming Body).
+
+    With byte_range set only that part is fetched; the response then carries
+    ContentRange. Raises RangeNotSatisfiableError if S3 cannot satisfy the
+    range, with the object size when S3 reports it.
     """
-    cfg = get_s3_config()
     client = get_s3_client()
-    return client.get_object(Bucket=cfg.bucket, Key=key)
-
-
-def delete_image(*, key: str) -> None:
-    cfg = get_s3_config()
+    if byte_range is None:
+        return await client.get_object(Bucket=_BUCKET, Key=key)
+    try:
+        return await client.get_object(Bucket=_BUCKET, Key=key, Range=byte_range)
+    except ClientError as e:
+        error = e.response.get("Error", {})
+        if error.get("Code") == "InvalidRange":
+            size = error.get("ActualObjectSize")
+            raise RangeNotSatisfiableError(int(size) if size else None) from e
+        raise
+
+
+async def delete_image(*, key: str) -> None:
     client = get_s3_client()
-    client.delete_object(Bucket=cfg.bucket, Key=key)
+    await client.delete_object(Bucket=_BUCKET, Key=key)
 
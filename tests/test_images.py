@@ -2,47 +2,137 @@ import io
 import os
 from datetime import datetime, timezone
 
+import httpx
 import pytest
-from fastapi.testclient import TestClient
+import pytest_asyncio
+import redis.asyncio as redis
+from fastapi import UploadFile
+from sqlalchemy.exc import OperationalError
 
+import cache as cache_module
 import db as db_module
 import s3_client as s3_module
+import routers.images as images_module
 from main import app
+from routers.images import _finish_upload, _unindex_name, prime_name_index
 
 
 class _FakeS3Body:
     def __init__(self, data: bytes):
         self._buf = io.BytesIO(data)
 
-    def read(self, n: int):
+    async def read(self, n: int):
         return self._buf.read(n)
 
+    async def iter_chunks(self, chunk_size: int):
+        while True:
+            chunk = self._buf.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.fail_next_sadd = False
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def setex(self, key, ttl, value):
+        self.data[key] = value
+
+    async def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    async def eval(self, script, numkeys, *args):
+        keys, argv = args[:numkeys], args[numkeys:]
+        if script == cache_module._SETEX_UNLESS_GUARDED:
+            if keys[1] in self.data:
+                return 0
+            await self.setex(keys[0], *argv)
+            return 1
+        if script == cache_module._INVALIDATE_SET:
+            self.data.pop(keys[0], None)
+            epoch = int(self.data.get(keys[1], b"0")) + 1
+            self.data[keys[1]] = str(epoch).encode()
+            return 1
+        if script == cache_module._MARK_READY_UNLESS_INVALIDATED:
+            if self.data.get(keys[1], b"").decode() != argv[0]:
+                return 0
+            await self.sadd(keys[0], argv[1])
+            return 1
+        raise NotImplementedError(script)
+
+    def expire_write_guards(self):
+        for key in [k for k in self.data if k.endswith(":write-guard")]:
+            del self.data[key]
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+    async def sadd(self, key, *members):
+        if self.fail_next_sadd:
+            self.fail_next_sadd = False
+            raise redis.RedisError("transient failure")
+        self.data.setdefault(key, set()).update(members)
+
+    async def srem(self, key, member):
+        self.data.get(key, set()).discard(member)
+
+    async def sismember(self, key, member):
+        return member in self.data.get(key, set())
+
+    async def smismember(self, key, members):
+        return [member in self.data.get(key, set()) for member in members]
+
 
 @pytest.fixture(autouse=True)
 def _env(monkeypatch):
     monkeypatch.setenv("AWS_S3_BUCKET", "test-bucket")
     monkeypatch.setenv("AWS_REGION", "us-east-1")
-    monkeypatch.setenv("DB_URL", "sqlite+pysqlite:///:memory:")
+    monkeypatch.setenv("DB_URL", "sqlite+aiosqlite:///:memory:")
 
 
-@pytest.fixture()
-def client(monkeypatch):
+@pytest_asyncio.fixture()
+async def client(monkeypatch):
     # Ensure db module uses an in-memory engine for this test run.
     db_module._ENGINE = None
     db_module._SESSION_FACTORY = None
+    cache_module._REDIS = None
 
     # Patch S3 operations.
     store = {}
 
-    def fake_upload_image(*, fileobj, key, content_type):
-        store[key] = fileobj.read()
+    async def fake_upload_image(*, fileobj, key, content_type):
+        store[key] = await fileobj.read()
 
-    def fake_download_image(*, key):
+    async def fake_download_image(*, key, byte_range=None):
         if key not in store:
             raise KeyError("missing")
-        return {"Body": _FakeS3Body(store[key]), "ContentType": "image/png"}
+        data = store[key]
+        if byte_range is None:
+            return {"Body": _FakeS3Body(data), "ContentType": "image/png", "ContentLength": len(data)}
+        first, _, last = byte_range[len("bytes="):].partition("-")
+        if not first:
+            start, end = len(data) - int(last), len(data) - 1
+        else:
+            start, end = int(first), min(int(last or len(data) - 1), len(data) - 1)
+        if start >= len(data):
+            raise s3_module.RangeNotSatisfiableError(object_size=len(data))
+        part = data[start:end + 1]
+        return {
+            "Body": _FakeS3Body(part),
+            "ContentType": "image/png",
+            "ContentLength": len(part),
+            "ContentRange": f"bytes {start}-{end}/{len(data)}",
+        }
 
-    def fake_delete_image(*, key):
+    async def fake_delete_image(*, key):
         store.pop(key, None)
 
     monkeypatch.setattr(s3_module, "upload_image", fake_upload_image)
@@ -50,50 +140,486 @@ def client(monkeypatch):
     monkeypatch.setattr(s3_module, "delete_image", fake_delete_image)
 
     # Initialize DB tables (startup event might not run in tests)
-    db_module.init_db(db_module.get_engine())
+    await db_module.init_db(db_module.get_engine())
 
-    return TestClient(app)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        yield c
+    if images_module._NAME_INDEX_PRIME_TASK is not None:
+        await images_module._NAME_INDEX_PRIME_TASK
+        images_module._NAME_INDEX_PRIME_TASK = None
+    await db_module.get_engine().dispose()
 
 
-def test_upload_and_metadata_and_download_and_delete(client):
+@pytest.mark.asyncio
+async def test_upload_and_metadata_and_download_and_delete(client):
     # Upload
-    resp = client.post(
+    resp = await client.post(
         "/images",
         files={"file": ("hello.png", b"PNGDATA", "image/png")},
         data={"name": "hello"},
     )
-    assert resp.status_code == 200, resp.text
+    assert resp.status_code == 202, resp.text
     meta = resp.json()
     assert meta["name"] == "hello"
     assert meta["extension"] == "png"
     assert meta["size_bytes"] == 7
+    assert meta["uploaded"] is False
     assert "last_updated_at" in meta
 
     # Metadata
-    resp = client.get("/images/hello/metadata")
+    resp = await client.get("/images/hello/metadata")
     assert resp.status_code == 200, resp.text
     meta2 = resp.json()
     assert meta2["name"] == "hello"
     assert meta2["extension"] == "png"
+    assert meta2["uploaded"] is True
 
     # Random metadata
-    resp = client.get("/images/random/metadata")
+    resp = await client.get("/images/random/metadata")
     assert resp.status_code == 200, resp.text
     rand_meta = resp.json()
     assert rand_meta["name"] == "hello"
 
     # Download
-    resp = client.get("/images/hello")
+    resp = await client.get("/images/hello")
     assert resp.status_code == 200, resp.text
     assert resp.content == b"PNGDATA"
     assert resp.headers["content-type"].startswith("image/")
 
     # Delete
-    resp = client.delete("/images/hello")
+    resp = await client.delete("/images/hello")
     assert resp.status_code == 200, resp.text
     assert resp.json() == {"name": "hello", "deleted": True}
 
     # Gone
-    resp = client.get("/images/hello/metadata")
+    resp = await client.get("/images/hello/metadata")
+    assert resp.status_code == 404
+
+
+
+@pytest.mark.asyncio
+async def test_download_range(client):
+    resp = await client.post(
+        "/images",
+        files={"file": ("hello.png", b"PNGDATA", "image/png")},
+        data={"name": "hello"},
+    )
+    assert resp.status_code == 202, resp.text
+
+    # Full download advertises range support
+    resp = await client.get("/images/hello")
+    assert resp.status_code == 200, resp.text
+    assert resp.headers["accept-ranges"] == "bytes"
+
+    # Partial content
+    resp = await client.get("/images/hello", headers={"Range": "bytes=1-3"})
+    assert resp.status_code == 206, resp.text
+    assert resp.content == b"NGD"
+    assert resp.headers["content-range"] == "bytes 1-3/7"
+
+    # Suffix range
+    resp = await client.get("/images/hello", headers={"Range": "bytes=-2"})
+    assert resp.status_code == 206, resp.text
+    assert resp.content == b"TA"
+
+    # Malformed and unsatisfiable ranges
+    resp = await client.get("/images/hello", headers={"Range": "bytes=abc"})
+    assert resp.status_code == 416
+    resp = await client.get("/images/hello", headers={"Range": "bytes=100-"})
+    assert resp.status_code == 416
+    assert resp.headers["content-range"] == "bytes */7"
+
+
+@pytest.mark.asyncio
+async def test_metadata_cache(client, monkeypatch):
+    fake_redis = _FakeRedis()
+    monkeypatch.setattr(cache_module, "_REDIS", fake_redis)
+
+    resp = await client.post(
+        "/images",
+        files={"file": ("hello.png", b"PNGDATA", "image/png")},
+        data={"name": "hello"},
+    )
+    assert resp.status_code == 202, resp.text
+
+    # Right after a write, lookups must not re-fill the entry
+    resp = await client.get("/images/hello/metadata")
+    assert resp.status_code == 200, resp.text
+    assert "img:hello" not in fake_redis.data
+    fake_redis.expire_write_guards()
+
+    # First lookup populates the cache, second one is served from it
+    resp = await client.get("/images/hello/metadata")
+    assert resp.status_code == 200, resp.text
+    assert "img:hello" in fake_redis.data
+    resp = await client.get("/images/hello/metadata")
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["size_bytes"] == 7
+
+    # Re-upload invalidates the entry
+    resp = await client.post(
+        "/images",
+        files={"file": ("hello.png", b"NEWPNGDATA", "image/png")},
+        data={"name": "hello"},
+    )
+    assert resp.status_code == 202, resp.text
+    assert "img:hello" not in fake_redis.data
+    assert "img:hello:write-guard" in fake_redis.data
+    resp = await client.get("/images/hello/metadata")
+    assert resp.json()["size_bytes"] == 10
+
+    # Delete invalidates the entry as well
+    resp = await client.delete("/images/hello")
+    assert resp.status_code == 200, resp.text
+    assert "img:hello" not in fake_redis.data
+    resp = await client.get("/images/hello/metadata")
+    assert resp.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_name_index_rejects_unknown_names(client, monkeypatch):
+    resp = await client.post(
+        "/images",
+        files={"file": ("hello.png", b"PNGDATA", "image/png")},
+        data={"name": "hello"},
+    )
+    assert resp.status_code == 202, resp.text
+
+    fake_redis = _FakeRedis()
+    monkeypatch.setattr(cache_module, "_REDIS", fake_redis)
+
+    # Prime the index from the database; "" marks it as complete
+    await prime_name_index()
+    assert fake_redis.data["images:names"] == {"", "hello"}
+
+    resp = await client.get("/images/hello/metadata")
+    assert resp.status_code == 200, resp.text
+
+    # A row missing from the primed index is answered as 404 by Redis alone
+    async with db_module.get_session_factory()() as db:
+        db.add(db_module.Image(name="ghost", size_bytes=1, extension="png", s3_key="images/ghost.png"))
+        await db.commit()
+    resp = await client.get("/images/ghost/metadata")
+    assert resp.status_code == 404
+
+    # Uploads and deletes keep the index in sync
+    resp = await client.post(
+        "/images",
+        files={"file": ("other.png", b"PNGDATA", "image/png")},
+        data={"name": "other"},
+    )
+    assert resp.status_code == 202, resp.text
+    assert "other" in fake_redis.data["images:names"]
+    resp = await client.delete("/images/other")
+    assert resp.status_code == 200, resp.text
+    assert "other" not in fake_redis.data["images:names"]
+
+
+@pytest.mark.asyncio
+async def test_upload_sync_and_failed_background_upload(client, monkeypatch):
+    # sync=true waits for S3 and returns the final state
+    resp = await client.post(
+        "/images?sync=true",
+        files={"file": ("hello.png", b"PNGDATA", "image/png")},
+        data={"name": "hello"},
+    )
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["uploaded"] is True
+
+    async def failing_upload_image(*, fileobj, key, content_type):
+        raise RuntimeError("S3 unavailable")
+
+    monkeypatch.setattr(s3_module, "upload_image", failing_upload_image)
+
+    resp = await client.post(
+        "/images?sync=true",
+        files={"file": ("other.png", b"PNGDATA", "image/png")},
+        data={"name": "other"},
+    )
+    assert resp.status_code == 502
+
+    # A failed background upload drops the pending row
+    resp = await client.post(
+        "/images",
+        files={"file": ("other.png", b"PNGDATA", "image/png")},
+        data={"name": "other"},
+    )
+    assert resp.status_code == 202, resp.text
+    resp = await client.get("/images/other/metadata")
+    assert resp.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_name_index_dropped_when_add_fails(client, monkeypatch):
+    fake_redis = _FakeRedis()
+    monkeypatch.setattr(cache_module, "_REDIS", fake_redis)
+    await prime_name_index()
+    assert "images:names" in fake_redis.data
+
+    # A failed SADD must not leave a ready set that is missing the new name
+    fake_redis.fail_next_sadd = True
+    resp = await client.post(
+        "/images?sync=true",
+        files={"file": ("hello.png", b"PNGDATA", "image/png")},
+        data={"name": "hello"},
+    )
+    assert resp.status_code == 200, resp.text
+    assert "" not in fake_redis.data.get("images:names", set())
+
+    resp = await client.get("/images/hello/metadata")
+    assert resp.status_code == 200, resp.text
+
+    # That lookup rebuilt the set from the database in the background
+    await images_module._NAME_INDEX_PRIME_TASK
+    assert fake_redis.data["images:names"] == {"", "hello"}
+
+
+@pytest.mark.asyncio
+async def test_failed_async_reupload_keeps_previous_image(client, monkeypatch):
+    resp = await client.post(
+        "/images?sync=true",
+        files={"file": ("hello.png", b"PNGDATA", "image/png")},
+        data={"name": "hello"},
+    )
+    assert resp.status_code == 200, resp.text
+
+    async def failing_upload_image(*, fileobj, key, content_type):
+        raise RuntimeError("S3 unavailable")
+
+    original_upload_image = s3_module.upload_image
+    monkeypatch.setattr(s3_module, "upload_image", failing_upload_image)
+
+    resp = await client.post(
+        "/images",
+        files={"file": ("hello.jpg", b"NEWJPEGDATA", "image/jpeg")},
+        data={"name": "hello"},
+    )
+    assert resp.status_code == 202, resp.text
+
+    # The stored image is untouched and still downloadable
+    resp = await client.get("/images/hello/metadata")
+    assert resp.status_code == 200, resp.text
+    meta = resp.json()
+    assert meta["size_bytes"] == 7
+    assert meta["extension"] == "png"
+    assert meta["uploaded"] is True
+    resp = await client.get("/images/hello")
+    assert resp.status_code == 200, resp.text
+    assert resp.content == b"PNGDATA"
+
+    # The released row can still be replaced by a later async upload
+    monkeypatch.setattr(s3_module, "upload_image", original_upload_image)
+    resp = await client.post(
+        "/images",
+        files={"file": ("hello.jpg", b"NEWJPEGDATA", "image/jpeg")},
+        data={"name": "hello"},
+    )
+    assert resp.status_code == 202, resp.text
+    resp = await client.get("/images/hello/metadata")
+    assert resp.json()["extension"] == "jpg"
+    assert resp.json()["size_bytes"] == 11
+
+
+@pytest.mark.asyncio
+async def test_superseded_background_upload_leaves_row_alone(client, monkeypatch):
+    # A pending row currently claimed by a newer upload
+    async with db_module.get_session_factory()() as db:
+        db.add(
+            db_module.Image(
+                name="hello",
+                size_bytes=7,
+                extension="png",
+                s3_key="images/hello.png",
+                uploaded=False,
+                upload_token="newer",
+            )
+        )
+        await db.commit()
+
+    async def failing_upload_image(*, fileobj, key, content_type):
+        raise RuntimeError("S3 unavailable")
+
+    monkeypatch.setattr(s3_module, "upload_image", failing_upload_image)
+
+    # The older upload's failure must not delete the newer upload's row
+    await _finish_upload(
+        fileobj=io.BytesIO(b"OLD"),
+        name="hello",
+        size_bytes=3,
+        extension="png",
+        key="images/hello.png",
+        content_type="image/png",
+        token="older",
+    )
+    resp = await client.get("/images/hello/metadata")
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["uploaded"] is False
+    assert resp.json()["size_bytes"] == 7
+
+
+@pytest.mark.asyncio
+async def test_stale_reader_cannot_refill_cache_after_write(client, monkeypatch):
+    fake_redis = _FakeRedis()
+    monkeypatch.setattr(cache_module, "_REDIS", fake_redis)
+
+    # A reader fetched the old row, then a writer committed and invalidated...
+    await cache_module.invalidate_json("img:hello")
+    # ...so the reader's late fill is refused.
+    await cache_module.set_json("img:hello", {"name": "hello"}, ttl_seconds=300)
+    assert "img:hello" not in fake_redis.data
+
+
+@pytest.mark.asyncio
+async def test_unindex_keeps_name_of_concurrently_uploaded_row(client, monkeypatch):
+    fake_redis = _FakeRedis()
+    monkeypatch.setattr(cache_module, "_REDIS", fake_redis)
+    await prime_name_index()
+
+    # A delete's SREM lands after an upload of the same name already committed
+    async with db_module.get_session_factory()() as db:
+        db.add(db_module.Image(name="hello", size_bytes=7, extension="png", s3_key="images/hello.png"))
+        await db.commit()
+        await fake_redis.sadd("images:names", "hello")
+
+        await _unindex_name(db, "hello")
+
+    assert "hello" in fake_redis.data["images:names"]
+    resp = await client.get("/images/hello/metadata")
+    assert resp.status_code == 200, resp.text
+
+
+@pytest.mark.asyncio
+async def test_name_index_rebuilt_lazily_after_invalidation(client, monkeypatch):
+    fake_redis = _FakeRedis()
+    monkeypatch.setattr(cache_module, "_REDIS", fake_redis)
+    resp = await client.post(
+        "/images?sync=true",
+        files={"file": ("hello.png", b"PNGDATA", "image/png")},
+        data={"name": "hello"},
+    )
+    assert resp.status_code == 200, resp.text
+    assert await cache_module.set_invalidate("images:names")
+
+    # A lookup against the unready set falls back to the DB and schedules a rebuild
+    resp = await client.get("/images/other/metadata")
     assert resp.status_code == 404
+    await images_module._NAME_INDEX_PRIME_TASK
+    assert {"", "hello"} <= fake_redis.data["images:names"]
+    assert "images:names:prime-lock" not in fake_redis.data
+
+
+@pytest.mark.asyncio
+async def test_name_index_not_marked_ready_if_invalidated_while_priming(client, monkeypatch):
+    fake_redis = _FakeRedis()
+    monkeypatch.setattr(cache_module, "_REDIS", fake_redis)
+    async with db_module.get_session_factory()() as db:
+        db.add(db_module.Image(name="hello", size_bytes=7, extension="png", s3_key="images/hello.png"))
+        await db.commit()
+
+    set_add = cache_module.set_add
 
+    async def set_add_then_invalidate(key, *members):
+        added = await set_add(key, *members)
+        await cache_module.set_invalidate(key)
+        return added
+
+    monkeypatch.setattr(cache_module, "set_add", set_add_then_invalidate)
+    await prime_name_index()
+    assert "" not in fake_redis.data.get("images:names", set())
+
+    # Another worker holding the lock keeps this one from scanning
+    monkeypatch.setattr(cache_module, "set_add", set_add)
+    assert await cache_module.acquire_lock("images:names:prime-lock", 300)
+    await prime_name_index()
+    assert "" not in fake_redis.data.get("images:names", set())
+
+    await cache_module.release_lock("images:names:prime-lock")
+    await prime_name_index()
+    assert {"", "hello"} <= fake_redis.data["images:names"]
+
+
+@pytest.mark.asyncio
+async def test_background_upload_of_deleted_image_removes_orphaned_object(client, monkeypatch):
+    deleted = []
+
+    async def recording_delete_image(*, key):
+        deleted.append(key)
+
+    monkeypatch.setattr(s3_module, "delete_image", recording_delete_image)
+
+    # The image was deleted while its upload was pending: nothing claims the object
+    await _finish_upload(
+        fileobj=UploadFile(io.BytesIO(b"PNGDATA")),
+        name="hello",
+        size_bytes=7,
+        extension="png",
+        key="images/hello.png",
+        content_type="image/png",
+        token="gone",
+    )
+    assert deleted == ["images/hello.png"]
+
+    # A newer pending upload of the same name will still write the key
+    async with db_module.get_session_factory()() as db:
+        db.add(
+            db_module.Image(
+                name="hello",
+                size_bytes=7,
+                extension="jpg",
+                s3_key="images/hello.jpg",
+                upload_token="newer",
+            )
+        )
+        await db.commit()
+    await _finish_upload(
+        fileobj=UploadFile(io.BytesIO(b"PNGDATA")),
+        name="hello",
+        size_bytes=7,
+        extension="png",
+        key="images/hello.png",
+        content_type="image/png",
+        token="older",
+    )
+    assert deleted == ["images/hello.png"]
+
+
+@pytest.mark.asyncio
+async def test_background_upload_retries_db_write(client, monkeypatch):
+    async with db_module.get_session_factory()() as db:
+        db.add(
+            db_module.Image(
+                name="hello",
+                size_bytes=7,
+                extension="png",
+                s3_key="images/hello.png",
+                uploaded=False,
+                upload_token="mine",
+            )
+        )
+        await db.commit()
+
+    session_factory = db_module.get_session_factory()
+    calls = []
+
+    def flaky_session_factory():
+        calls.append(None)
+        if len(calls) == 1:
+            raise OperationalError("UPDATE images", {}, Exception("connection reset"))
+        return session_factory
+
+    monkeypatch.setattr(images_module, "get_session_factory", flaky_session_factory)
+    monkeypatch.setattr(images_module, "_FINISH_UPLOAD_DB_RETRY_SECONDS", 0)
+
+    await _finish_upload(
+        fileobj=UploadFile(io.BytesIO(b"PNGDATA")),
+        name="hello",
+        size_bytes=7,
+        extension="png",
+        key="images/hello.png",
+        content_type="image/png",
+        token="mine",
+    )
+    resp = await client.get("/images/hello/metadata")
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["uploaded"] is True